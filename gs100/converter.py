@@ -5,25 +5,38 @@ Ensures that each question has a constant number of pages.
 __all__ = ['convert']
 
 from bs4 import BeautifulSoup
+from functools import lru_cache
 from nbconvert import HTMLExporter
-from toolz.curried import first, filter
+import io
 import logging
 import nbformat
 import os
 import pdfkit
-import PyPDF2
-import subprocess
-import sys
+import pypdf
+import re
+import shutil
+import threading
 import time
 
+try:
+    from watchdog.events import FileSystemEventHandler
+    from watchdog.observers import Observer
+except ImportError:
+    Observer = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 # Default number of pages per question
 DEFAULT_PAGES_PER_Q = 2
 
 # Tags on cells that need to get exported
-TAGS = ['written', 'student']
+TAGS = frozenset(['written', 'student'])
 
 # Tags on solution cells that need to get exported
-SOL_TAGS = ['written', 'solution']
+SOL_TAGS = frozenset(['written', 'solution'])
 
 WKHTMLTOPDF_URL = 'https://github.com/JazzCore/python-pdfkit/wiki/Installing-wkhtmltopdf'  # noqa: E501
 
@@ -37,9 +50,9 @@ def convert(filename,
             num_questions=None,
             solution=False,
             pages_per_q=DEFAULT_PAGES_PER_Q,
-            folder='question_pdfs',
             output='gradescope.pdf',
-            zoom=1):
+            zoom=1,
+            javascript=False):
     """
     Public method that exports nb to PDF and pads all the questions.
 
@@ -51,26 +64,29 @@ def convert(filename,
 
     If solution=True, we'll export solution cells instead of student cells. Use
     this option to generate the solutions to upload to Gradescope.
+
+    JavaScript is turned off during rendering since notebook outputs are
+    normally static. Pass javascript=True if your answer cells only render
+    with JS enabled.
     """
     check_for_wkhtmltohtml()
     save_notebook(filename)
 
     nb = read_nb(filename, solution=solution)
-    pdf_names = create_question_pdfs(nb,
-                                     pages_per_q=pages_per_q,
-                                     folder=folder,
-                                     zoom=zoom)
-    merge_pdfs(pdf_names, output)
-
-    # The first pdf generated is the email PDF
-    n_questions_found = len(pdf_names) - 1
+    pdf = create_question_pdfs(nb, pages_per_q=pages_per_q, zoom=zoom,
+                               javascript=javascript)
+    with open(output, 'wb') as out_file:
+        pdf.write(out_file)
+
+    # The first section of the PDF is the email section
+    n_questions_found = len(nb['cells']) - 1
     if num_questions is not None and n_questions_found != num_questions:
         logging.warning(
             'We expected there to be {} questions but there are only {} in '
             'your final PDF. Gradescope will most likely not accept your '
             'submission. Double check that you wrote your answers in the '
             'cells that we provided.'
-            .format(num_questions, len(pdf_names))
+            .format(num_questions, n_questions_found)
         )
 
     try:
@@ -91,17 +107,32 @@ def convert(filename,
 # Private methods
 ##############################################################################
 
+# Caches the wkhtmltopdf location so repeated convert() calls don't rescan
+# the PATH
+_WKHTMLTOPDF_PATH = None
+
+# Caches the pdfkit configuration, which otherwise forks a subprocess to
+# locate wkhtmltopdf on every render
+_PDFKIT_CONFIG = None
+
+
+def _pdfkit_config() -> 'pdfkit.configuration.Configuration':
+    global _PDFKIT_CONFIG
+    if _PDFKIT_CONFIG is None:
+        check_for_wkhtmltohtml()
+        _PDFKIT_CONFIG = pdfkit.configuration(wkhtmltopdf=_WKHTMLTOPDF_PATH)
+    return _PDFKIT_CONFIG
+
+
 def check_for_wkhtmltohtml():
     """
     Checks to see if the wkhtmltohtml binary is installed. Raises error if not.
     """
-    locator = 'where' if sys.platform == 'win32' else 'which'
+    global _WKHTMLTOPDF_PATH
+    if _WKHTMLTOPDF_PATH is None:
+        _WKHTMLTOPDF_PATH = shutil.which('wkhtmltopdf')
 
-    wkhtmltopdf = (subprocess.Popen([locator, 'wkhtmltopdf'],
-                                    stdout=subprocess.PIPE)
-                   .communicate()[0].strip())
-
-    if not os.path.exists(wkhtmltopdf):
+    if _WKHTMLTOPDF_PATH is None:
         logging.error(
             'No wkhtmltopdf executable found. Please install '
             'wkhtmltopdf before trying again - {}'.format(WKHTMLTOPDF_URL))
@@ -134,7 +165,50 @@ def save_notebook(filename):
 def wait_for_save(filename, timeout=5):
     """Waits for FILENAME to update, waiting up to TIMEOUT seconds.
     Returns True if a save was detected, and False otherwise.
+
+    Uses filesystem events (inotify/FSEvents via watchdog) so the save is
+    noticed as soon as it happens. Falls back to polling if watchdog isn't
+    installed.
     """
+    if Observer is None:
+        return _poll_for_save(filename, timeout)
+
+    filename = os.path.abspath(filename)
+    modification_time = os.path.getmtime(filename)
+    saved = threading.Event()
+
+    class SaveHandler(FileSystemEventHandler):
+        def on_any_event(self, event):
+            # Jupyter saves atomically by default (write to a temp file,
+            # then rename onto the notebook), so the notebook only shows up
+            # as a moved event's dest_path - never as a modified src_path.
+            # Treat any event in the directory as a cue and let the
+            # mtime/size re-check decide; the file can vanish between the
+            # event and the stat (e.g. the temp file), so ignore that.
+            try:
+                if (os.path.getmtime(filename) > modification_time
+                        and os.path.getsize(filename) > 0):
+                    saved.set()
+            except FileNotFoundError:
+                pass
+
+    observer = Observer()
+    observer.schedule(SaveHandler(), os.path.dirname(filename))
+    observer.start()
+    try:
+        # The save may have already landed before the observer started
+        # watching, in which case no event will ever fire
+        if (os.path.getmtime(filename) > modification_time
+                and os.path.getsize(filename) > 0):
+            return True
+        return saved.wait(timeout=timeout)
+    finally:
+        observer.stop()
+        observer.join()
+
+
+def _poll_for_save(filename, timeout):
+    """Fallback for wait_for_save that polls the file's mtime every 200ms."""
     modification_time = os.path.getmtime(filename)
     start_time = time.time()
     while time.time() < start_time + timeout:
@@ -145,6 +219,9 @@ def wait_for_save(filename, timeout=5):
     return False
 
 
+_EMAIL_RE = re.compile(r'Successfully logged in as (\S+)')
+
+
 def find_student_email(nb) -> str:
     '''
     Looks for the OkPy-generated string:
@@ -155,20 +232,18 @@ def find_student_email(nb) -> str:
 
     Raises a ValueError if email not found.
     '''
-    search = 'Successfully logged in as '
-
-    cells = [cell for cell in nb.cells if 'outputs' in cell]
-    for cell in cells:
-        for output in cell.outputs:
-            if 'text' in output and search in output.text:
-                return output.text.split(search)[1].strip()
+    for cell in nb.cells:
+        for output in cell.get('outputs', []):
+            match = _EMAIL_RE.search(output.get('text', ''))
+            if match:
+                return match.group(1)
     raise ValueError('Error: was not able to get email from ok.auth() cell.'
                      'Please run that cell and try again.')
 
 
 def cell_has_tags(cell, tags_to_check) -> bool:
     return ('tags' in cell.metadata
-            and all(tag in cell.metadata.tags for tag in tags_to_check))
+            and tags_to_check.issubset(cell.metadata.tags))
 
 
 def remove_input(cell) -> nbformat.NotebookNode:
@@ -182,8 +257,17 @@ def read_nb(filename, solution) -> nbformat.NotebookNode:
     Takes in a filename of a notebook and returns a notebook object containing
     only the cell outputs to export.
     """
-    with open(filename, 'r') as f:
-        nb = nbformat.read(f, as_version=4)
+    # orjson parses notebook-sized JSON several times faster than the stdlib
+    # json that nbformat.read uses, and skipping validation avoids another
+    # walk of the whole tree. v4.to_notebook rejoins the line lists Jupyter
+    # stores for source/text fields into plain strings, like nbformat.read
+    # does.
+    if orjson is not None:
+        with open(filename, 'rb') as f:
+            nb = nbformat.v4.to_notebook(orjson.loads(f.read()))
+    else:
+        with open(filename, 'r') as f:
+            nb = nbformat.read(f, as_version=4)
 
     email = find_student_email(nb)
     preamble = nbformat.v4.new_markdown_cell(
@@ -198,15 +282,18 @@ def read_nb(filename, solution) -> nbformat.NotebookNode:
     return nb
 
 
+# Shared exporter so repeated convert() calls in one session don't recompile
+# the Jinja templates
+_HTML_EXPORTER = HTMLExporter()
+_HTML_EXPORTER.template_file = 'basic'
+
+
 def nb_to_html_cells(nb) -> list:
     """
     Converts notebook to an iterable of BS4 HTML nodes. Images are inline.
     """
-    html_exporter = HTMLExporter()
-    html_exporter.template_file = 'basic'
-
-    (body, resources) = html_exporter.from_notebook_node(nb)
-    return BeautifulSoup(body, 'html.parser').findAll('div', class_='cell')
+    (body, resources) = _HTML_EXPORTER.from_notebook_node(nb)
+    return BeautifulSoup(body, 'lxml').findAll('div', class_='cell')
 
 
 def nb_to_q_nums(nb) -> list:
@@ -215,39 +302,11 @@ def nb_to_q_nums(nb) -> list:
     """
     def q_num(cell):
         assert cell.metadata.tags
-        return first(filter(lambda t: 'q' in t, cell.metadata.tags))
+        return next(t for t in cell.metadata.tags if 'q' in t)
 
     return [q_num(cell) for cell in nb['cells']]
 
 
-def pad_pdf_pages(pdf_name, pages_per_q) -> None:
-    """
-    Checks if PDF has the correct number of pages. If it has too many, warns
-    the user. If it has too few, adds blank pages until the right length is
-    reached.
-    """
-    pdf = PyPDF2.PdfFileReader(pdf_name)
-    output = PyPDF2.PdfFileWriter()
-    num_pages = pdf.getNumPages()
-    if num_pages > pages_per_q:
-        logging.warning('{} has {} pages. Only the first '
-                        '{} pages will get output.'
-                        .format(pdf_name, num_pages, pages_per_q))
-
-    # Copy over up to pages_per_q pages
-    for page in range(min(num_pages, pages_per_q)):
-        output.addPage(pdf.getPage(page))
-
-    # Pad if necessary
-    if num_pages < pages_per_q:
-        for page in range(pages_per_q - num_pages):
-            output.addBlankPage()
-
-    # Output the PDF
-    with open(pdf_name, 'wb') as out_file:
-        output.write(out_file)
-
-
 # Options to pass into pdfkit
 PDF_OPTS = {
     'page-size': 'Letter',
@@ -257,47 +316,122 @@ PDF_OPTS = {
     'margin-left': '0.25in',
     'encoding': "UTF-8",
 
+    # Generate PDF outline entries from headings so we can find the page
+    # each question starts on in the combined PDF
+    'outline': '',
+
+    # Notebook outputs are static, so skip the JS engine and don't block on
+    # broken remote resources
+    'disable-javascript': '',
+    'no-stop-slow-scripts': '',
+    'load-error-handling': 'ignore',
+    'load-media-error-handling': 'ignore',
+
     'quiet': '',
 }
 
 ZOOM_FACTOR = 4
 
 
-def create_question_pdfs(nb, pages_per_q, folder, zoom) -> list:
+@lru_cache(maxsize=None)
+def _make_pdf_options(zoom, javascript=False) -> dict:
     """
-    Converts each cells in tbe notebook to a PDF named something like
-    'q04c.pdf'. Places PDFs in the specified folder and returns the list of
-    created PDF locations.
+    Assembles the pdfkit options for the given settings. Cached so repeated
+    convert() calls with the same settings reuse one dict; callers must not
+    mutate the result.
     """
-    html_cells = nb_to_html_cells(nb)
-    q_nums = nb_to_q_nums(nb)
-
-    os.makedirs(folder, exist_ok=True)
-
     pdf_options = PDF_OPTS.copy()
     pdf_options['zoom'] = ZOOM_FACTOR * zoom
+    if javascript:
+        del pdf_options['disable-javascript']
+        pdf_options['enable-javascript'] = ''
+    return pdf_options
+
+
+# Prefix that tells the hidden marker headings apart from headings in the
+# notebook itself (the email preamble and student markdown also produce
+# h1-h6 outline entries)
+QUESTION_MARKER = 'gs100-q-start:'
+
+# Wraps each question's HTML so that it starts on a fresh page. The hidden
+# <h1> becomes a PDF outline entry that tells us which page each question
+# starts on after the combined render.
+QUESTION_HTML = (
+    '<div style="page-break-before: always;">'
+    '<h1 style="font-size: 0; margin: 0; visibility: hidden;">'
+    + QUESTION_MARKER + '{}</h1>'
+    '{}</div>'
+)
 
-    pdf_names = []
-    for question, cell in zip(q_nums, html_cells):
-        # Create question PDFs
-        pdf_name = os.path.join(folder, '{}.pdf'.format(question))
-
-        pdfkit.from_string(cell.prettify(), pdf_name, options=pdf_options)
-
-        pad_pdf_pages(pdf_name, pages_per_q)
 
-        print('Created ' + pdf_name)
-        pdf_names.append(pdf_name)
-    return pdf_names
+def _question_start_pages(pdf, n_questions) -> list:
+    """
+    Reads the PDF outline and returns the zero-indexed page each question
+    starts on, in question order. Only outline entries carrying the
+    QUESTION_MARKER prefix count; other headings in the rendered notebook
+    also land in the outline and must be ignored.
+    """
+    def flatten(outlines):
+        for item in outlines:
+            if isinstance(item, list):
+                yield from flatten(item)
+            else:
+                yield item
+
+    starts = sorted(pdf.get_destination_page_number(dest)
+                    for dest in flatten(pdf.outline)
+                    if (dest.title or '').startswith(QUESTION_MARKER))
+    if len(starts) != n_questions:
+        raise ValueError(
+            'Expected {} question markers in the rendered PDF but found {}. '
+            'The generated PDF would be misaligned, so we stopped instead.'
+            .format(n_questions, len(starts)))
+    return starts
 
 
-def merge_pdfs(pdf_names, output) -> None:
+def create_question_pdfs(nb, pages_per_q, zoom, javascript=False) \
+        -> pypdf.PdfWriter:
     """
-    Merges all pdfs together into a single long PDF.
+    Converts the cells in tbe notebook to a single PDF where each question
+    takes exactly pages_per_q pages. Returns the PDF as an in-memory
+    PdfWriter; nothing gets written to disk here.
+
+    All questions get rendered in a single wkhtmltopdf invocation so that the
+    multi-second browser startup cost is paid once instead of once per
+    question. The combined PDF then gets split into per-question page ranges,
+    each padded or truncated to exactly pages_per_q pages.
     """
-    merger = PyPDF2.PdfFileMerger()
+    html_cells = nb_to_html_cells(nb)
+    q_nums = nb_to_q_nums(nb)
 
-    for filename in pdf_names:
-        merger.append(filename)
-    merger.write(output)
-    merger.close()
+    pdf_options = _make_pdf_options(zoom, javascript)
+
+    # str(cell) emits compact HTML; prettify() would only bloat the bytes
+    # wkhtmltopdf has to tokenize
+    combined_html = ''.join(
+        QUESTION_HTML.format(question, str(cell))
+        for question, cell in zip(q_nums, html_cells)
+    )
+    pdf_bytes = pdfkit.from_string(combined_html, False, options=pdf_options,
+                                   configuration=_pdfkit_config())
+
+    pdf = pypdf.PdfReader(io.BytesIO(pdf_bytes))
+    starts = _question_start_pages(pdf, len(q_nums))
+    ends = starts[1:] + [len(pdf.pages)]
+
+    output = pypdf.PdfWriter()
+    for question, start, end in zip(q_nums, starts, ends):
+        num_pages = end - start
+        if num_pages > pages_per_q:
+            logging.warning('{} has {} pages. Only the first '
+                            '{} pages will get output.'
+                            .format(question, num_pages, pages_per_q))
+
+        # Copy over up to pages_per_q pages, then pad if necessary
+        for page in range(start, start + min(num_pages, pages_per_q)):
+            output.add_page(pdf.pages[page])
+        for _ in range(pages_per_q - num_pages):
+            output.add_blank_page()
+
+        print('Added ' + question)
+    return output
@@ -45,12 +45,14 @@ setup(
 
     packages=find_packages(exclude=['contrib', 'docs', 'tests']),
     install_requires=[
-        'toolz>=0.8',
         'nbformat>=4',
+        'orjson>=3',
         'nbconvert>=5',
         'beautifulsoup4>=4',
+        'lxml>=3',
         'pdfkit>=0.6',
-        'PyPDF2>=1.26',
+        'pypdf>=3.0',
+        'watchdog>=0.8',
     ],
 
     extras_require={